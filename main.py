@@ -1,15 +1,52 @@
+import logging
 import os
-from typing import List, Optional, Dict, Any
+import re
+from typing import Optional, Dict, Any
 from datetime import datetime, timezone
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+import orjson
+from redis import RedisError
 
-from database import db, create_document, get_documents
+from database import db, cache, create_document, get_documents, aggregate_documents, aggregate_cursor
 
-app = FastAPI(title="iBigay API", description="Hyperlocal, zero-waste giving platform")
+logger = logging.getLogger(__name__)
+
+
+# ------------------ JSON ------------------
+
+# BSON types orjson cannot encode natively, looked up by exact type
+_BSON_CONVERTERS = {ObjectId: str}
+
+
+def _bson_default(o):
+    conv = _BSON_CONVERTERS.get(type(o))
+    if conv is None:
+        raise TypeError
+    return conv(o)
+
+
+def _dumps(content) -> bytes:
+    # datetimes are encoded by orjson itself; pymongo hands them back as naive UTC
+    return orjson.dumps(content, default=_bson_default, option=orjson.OPT_NAIVE_UTC)
+
+
+class MongoJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+
+app = FastAPI(
+    title="iBigay API",
+    description="Hyperlocal, zero-waste giving platform",
+    default_response_class=MongoJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,26 +59,17 @@ app.add_middleware(
 
 # ------------------ Utilities ------------------
 
-def serialize_id(value):
-    if isinstance(value, ObjectId):
-        return str(value)
-    return value
-
-
 def serialize_doc(doc: Dict[str, Any]):
+    # renames _id in place; remaining values are left to _dumps
     if not doc:
         return doc
-    out = {}
-    for k, v in doc.items():
-        if k == "_id":
-            out["id"] = serialize_id(v)
-        elif isinstance(v, ObjectId):
-            out[k] = str(v)
-        elif isinstance(v, datetime):
-            out[k] = v.isoformat()
-        else:
-            out[k] = v
-    return out
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+def _geo_point(lat, lng):
+    return {"type": "Point", "coordinates": [lng, lat]}
 
 
 # ------------------ Models ------------------
@@ -63,8 +91,8 @@ class CreateItemRequest(BaseModel):
     unit: Optional[str] = None
     photo_url: Optional[str] = None
     expiry_date: Optional[datetime] = None
-    location_lat: float
-    location_lng: float
+    location_lat: float = Field(..., ge=-90, le=90)
+    location_lng: float = Field(..., ge=-180, le=180)
     barangay: Optional[str] = None
 
 
@@ -91,15 +119,52 @@ class SendMessageRequest(BaseModel):
     text: str
 
 
+# ------------------ Startup ------------------
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    # setup problems are logged rather than aborting startup, so /test can still report them
+    try:
+        # one-off backfill of GeoJSON points for items created before the geo index
+        # existed; recorded in `migration` so later startups skip the collection scan
+        if await db["migration"].find_one({"_id": "item_location_backfill"}) is None:
+            await db["item"].update_many(
+                {
+                    "location": {"$exists": False},
+                    "location_lat": {"$gte": -90, "$lte": 90},
+                    "location_lng": {"$gte": -180, "$lte": 180},
+                },
+                [{"$set": {"location": {"type": "Point", "coordinates": ["$location_lng", "$location_lat"]}}}],
+            )
+            await db["migration"].update_one(
+                {"_id": "item_location_backfill"},
+                {"$setOnInsert": {"applied_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        await db["item"].create_index([("location", "2dsphere")])
+        # also serves plain user_id lookups through its prefix
+        await db["item"].create_index([("user_id", 1), ("available", 1)])
+        await db["message"].create_index([("chat_id", 1), ("_id", 1)])
+        try:
+            await db["user"].create_index("email", unique=True)
+        except OperationFailure:
+            # e.g. existing duplicate emails; registration is not deduplicated until fixed
+            logger.exception("Could not create unique index on user.email")
+    except PyMongoError:
+        logger.exception("Skipping MongoDB index setup")
+
+
 # ------------------ Root & Health ------------------
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "iBigay API is running"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -116,7 +181,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -132,156 +197,269 @@ def test_database():
 # ------------------ Auth (Simple) ------------------
 
 @app.post("/api/auth/register")
-def register_user(req: RegisterUserRequest):
-    data = req.model_dump()
-    # naive uniqueness check on email
-    existing = db["user"].find_one({"email": req.email}) if db else None
-    if existing:
+async def register_user(req: RegisterUserRequest):
+    data = dict(req.__dict__)
+    # uniqueness is enforced by the unique index on email
+    try:
+        user_id = await create_document("user", data)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Email already registered")
-    user_id = create_document("user", data)
-    return {"id": user_id, **data}
+    return MongoJSONResponse({"id": user_id, **data})
 
 
 # ------------------ Items ------------------
 
 @app.post("/api/items")
-def create_item(req: CreateItemRequest):
-    data = req.model_dump()
-    item_id = create_document("item", data)
-    return {"id": item_id, **data}
+async def create_item(req: CreateItemRequest):
+    data = dict(req.__dict__)
+    item_id = await create_document("item", {**data, "location": _geo_point(req.location_lat, req.location_lng)})
+    return MongoJSONResponse({"id": item_id, **data})
 
 
-def _haversine_km(lat1, lon1, lat2, lon2):
-    from math import radians, sin, cos, sqrt, atan2
-    R = 6371.0
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return R * c
+# listings are cached per ~100 m cell; new items show up once the entry expires
+ITEMS_CACHE_TTL = 60
 
 
-@app.get("/api/items")
-def list_items(lat: float, lng: float, radius_km: float = 2.0):
-    docs = get_documents("item")
-    enriched: List[Dict[str, Any]] = []
-    for d in docs:
-        d_ser = serialize_doc(d)
+# fields returned by the item listing; leaves out the internal GeoJSON `location`
+ITEM_LIST_PROJECTION = {
+    "_id": 1, "user_id": 1, "title": 1, "description": 1, "category": 1,
+    "quantity": 1, "unit": 1, "photo_url": 1, "expiry_date": 1,
+    "location_lat": 1, "location_lng": 1, "barangay": 1, "available": 1,
+    "created_at": 1, "updated_at": 1, "distance_km": 1,
+}
+
+# map-marker listing; also drops the long description/photo_url strings
+ITEM_GEO_PROJECTION = {
+    k: v for k, v in ITEM_LIST_PROJECTION.items() if k not in ("description", "photo_url")
+}
+
+
+async def _nearby_items(lat: float, lng: float, radius_km: float, projection: Dict[str, int], cache_prefix: str):
+    # snap to the ~100 m cache cell so a cached body is the same for every caller in it
+    lat, lng = round(lat, 3), round(lng, 3)
+    cache_key = f"{cache_prefix}:{lat}:{lng}:{radius_km}"
+    if cache is not None:
         try:
-            dist = _haversine_km(lat, lng, float(d_ser.get("location_lat")), float(d_ser.get("location_lng")))
-        except Exception:
-            dist = 9999
-        d_ser["distance_km"] = round(dist, 2)
-        if dist <= radius_km and d_ser.get("available", True):
-            enriched.append(d_ser)
-    # sort by proximity
-    enriched.sort(key=lambda x: x.get("distance_km", 9999))
-    return enriched
+            cached = await cache.get(cache_key)
+        except RedisError:
+            cached = None
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+
+    # the 2dsphere index filters by radius and returns nearest first, with distances
+    pipeline = [
+        {"$geoNear": {
+            "near": _geo_point(lat, lng),
+            "key": "location",
+            "distanceField": "distance_km",
+            "distanceMultiplier": 0.001,
+            "maxDistance": radius_km * 1000,
+            "query": {"available": {"$ne": False}},
+            "spherical": True,
+        }},
+        {"$project": projection},
+    ]
+    cursor = aggregate_cursor("item", pipeline).__aiter__()
+    # run the query before the 200 goes out, so its errors still surface as a 500
+    first = await anext(cursor, None)
+
+    async def docs():
+        if first is not None:
+            yield first
+            async for d in cursor:
+                yield d
+
+    # chunks are only kept around when the result is going into the cache
+    chunks = [b"["]
+    complete = False
+
+    async def stream():
+        nonlocal complete
+        yield b"["
+        sep = b""
+        async for d in docs():
+            d["distance_km"] = round(d["distance_km"], 2)
+            chunk = sep + _dumps(serialize_doc(d))
+            sep = b","
+            if cache is not None:
+                chunks.append(chunk)
+            yield chunk
+        chunks.append(b"]")
+        yield b"]"
+        complete = True
+
+    async def store():
+        # runs after the body has been sent, so a slow Redis never holds the response open
+        if not complete:
+            return
+        try:
+            await cache.set(cache_key, b"".join(chunks), ex=ITEMS_CACHE_TTL)
+        except RedisError:
+            pass
+
+    background = BackgroundTask(store) if cache is not None else None
+    return StreamingResponse(stream(), media_type="application/json", background=background)
+
+
+@app.get("/api/items")
+async def list_items(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(2.0, gt=0, description="Search radius in km"),
+):
+    return await _nearby_items(lat, lng, radius_km, ITEM_LIST_PROJECTION, "items")
+
+
+@app.get("/api/items/geo")
+async def list_items_geo(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(2.0, gt=0, description="Search radius in km"),
+):
+    return await _nearby_items(lat, lng, radius_km, ITEM_GEO_PROJECTION, "items-geo")
 
 
 # ------------------ AI: Cen-'tipid' ------------------
 
+# (keywords, tips, recipes), applied in this order when any keyword appears
+_TIPID_RULES = [
+    (
+        ("banana",),
+        ["Freeze overripe bananas for smoothies or baking."],
+        ["Banana Bread na Pang-tipid", "Smoothie: saging + gatas + yelo", "Maruya / Banana Fritters"],
+    ),
+    (
+        ("bread", "tinapay"),
+        ["Gawing breadcrumbs o croutons ang matigas na tinapay."],
+        ["French Toast / Toasted Bread with itlog", "Bread Pudding sa Kaldero"],
+    ),
+    (
+        ("rice", "kanin"),
+        ["Gawing sinangag ang natirang kanin—perfect for breakfast!"],
+        ["Sinangag with Garlic at gulay", "Arroz Caldo kung sabaw ang hanap"],
+    ),
+    (
+        ("vegetable", "gulay", "lettuce", "carrot"),
+        ["Gamitin sa stir-fry o soup ang nalalantang gulay."],
+        ["Gulay Stir-fry na may toyo at bawang", "Pickled Gulay para tumagal"],
+    ),
+]
+
+# one pass over the text finds every keyword; the lookahead keeps overlapping hits
+# and each rule gets its own group, so match.lastindex - 1 is the rule index
+_TIPID_PATTERN = re.compile(
+    "(?=" + "|".join("(" + "|".join(map(re.escape, keywords)) + ")" for keywords, _, _ in _TIPID_RULES) + ")",
+    re.IGNORECASE,
+)
+
+
 def _generate_tipid_suggestions(title: str, description: Optional[str], category: Optional[str]):
-    text = f"{title} {description or ''}".lower()
-    tips = []
-    recipes = []
-
-    def add_tip(t):
-        if t not in tips:
-            tips.append(t)
-
-    def add_recipe(r):
-        if r not in recipes:
-            recipes.append(r)
-
-    if "banana" in text:
-        add_tip("Freeze overripe bananas for smoothies or baking.")
-        add_recipe("Banana Bread na Pang-tipid")
-        add_recipe("Smoothie: saging + gatas + yelo")
-        add_recipe("Maruya / Banana Fritters")
-    if "bread" in text or "tinapay" in text:
-        add_tip("Gawing breadcrumbs o croutons ang matigas na tinapay.")
-        add_recipe("French Toast / Toasted Bread with itlog")
-        add_recipe("Bread Pudding sa Kaldero")
-    if "rice" in text or "kanin" in text:
-        add_tip("Gawing sinangag ang natirang kanin—perfect for breakfast!")
-        add_recipe("Sinangag with Garlic at gulay")
-        add_recipe("Arroz Caldo kung sabaw ang hanap")
-    if "vegetable" in text or "gulay" in text or "lettuce" in text or "carrot" in text:
-        add_tip("Gamitin sa stir-fry o soup ang nalalantang gulay.")
-        add_recipe("Gulay Stir-fry na may toyo at bawang")
-        add_recipe("Pickled Gulay para tumagal")
+    # dicts keep insertion order and dedupe in O(1)
+    tips: Dict[str, None] = {}
+    recipes: Dict[str, None] = {}
+
+    # scanned case-insensitively as-is, without building a lowered copy
+    matched = set()
+    for part in (title, description):
+        if part:
+            matched.update(m.lastindex - 1 for m in _TIPID_PATTERN.finditer(part))
+    for i, (_, rule_tips, rule_recipes) in enumerate(_TIPID_RULES):
+        if i in matched:
+            tips.update(dict.fromkeys(rule_tips))
+            recipes.update(dict.fromkeys(rule_recipes))
     if category == "household":
-        add_tip("Repurpose jars/containers for storage.")
-        add_tip("Donate locally para hindi mapunta sa landfill.")
+        tips["Repurpose jars/containers for storage."] = None
+        tips["Donate locally para hindi mapunta sa landfill."] = None
     if not tips and not recipes:
-        add_tip("Check your fridge first—baka pwedeng i-recipe na! 😄")
-        add_recipe("Fried Rice ng Bahay")
+        tips["Check your fridge first—baka pwedeng i-recipe na! 😄"] = None
+        recipes["Fried Rice ng Bahay"] = None
 
     message = {
         "mascot": {
             "name": "Cen-'tipid'",
             "tagline": "Pag 'di na kailangan, wag itapon—I-Bigay o I-kusina!",
         },
-        "tips": tips,
-        "recipes": recipes
+        "tips": list(tips),
+        "recipes": list(recipes)
     }
     return message
 
 
 @app.post("/api/ai/tipid")
-def tipid_ai(req: TipidRequest):
+async def tipid_ai(req: TipidRequest):
     return _generate_tipid_suggestions(req.title, req.description, req.category)
 
 
 # ------------------ Chat ------------------
 
 @app.post("/api/chats")
-def create_chat(req: CreateChatRequest):
-    data = req.model_dump()
-    chat_id = create_document("chat", {**data, "created_at": datetime.now(timezone.utc)})
-    return {"id": chat_id, **data}
+async def create_chat(req: CreateChatRequest):
+    data = dict(req.__dict__)
+    chat_id = await create_document("chat", {**data, "created_at": datetime.now(timezone.utc)})
+    return MongoJSONResponse({"id": chat_id, **data})
 
 
 @app.get("/api/chats/{chat_id}/messages")
-def get_messages(chat_id: str):
-    docs = get_documents("message", {"chat_id": chat_id})
-    return [serialize_doc(d) for d in docs]
+async def get_messages(chat_id: str):
+    docs = await get_documents("message", {"chat_id": chat_id}, sort=[("_id", 1)])
+    return MongoJSONResponse(content=[serialize_doc(d) for d in docs])
 
 
 @app.post("/api/chats/{chat_id}/messages")
-def send_message(chat_id: str, req: SendMessageRequest):
-    data = req.model_dump()
-    msg_id = create_document("message", {**data, "chat_id": chat_id})
-    return {"id": msg_id, **data, "chat_id": chat_id}
+async def send_message(chat_id: str, req: SendMessageRequest):
+    data = dict(req.__dict__)
+    msg_id = await create_document("message", {**data, "chat_id": chat_id})
+    return MongoJSONResponse({"id": msg_id, **data, "chat_id": chat_id})
 
 
 # ------------------ Activity ------------------
 
+UNIT_TO_KG = {
+    "kg": 1.0, "kilo": 1.0, "kilogram": 1.0, "kilograms": 1.0,
+    "g": 0.001, "gram": 0.001, "grams": 0.001,
+    "lb": 0.453592, "lbs": 0.453592, "pound": 0.453592, "pounds": 0.453592,
+}
+
+# heuristic: 0.2kg per piece/pack
+DEFAULT_KG_PER_UNIT = 0.2
+
+# one $switch branch per conversion factor, built once from UNIT_TO_KG
+_UNIT_TO_KG_BRANCHES = [
+    {"case": {"$in": ["$$unit", [u for u, f in UNIT_TO_KG.items() if f == factor]]}, "then": factor}
+    for factor in dict.fromkeys(UNIT_TO_KG.values())
+]
+
+
 @app.get("/api/users/{user_id}/stats")
-def user_stats(user_id: str):
-    items = get_documents("item", {"user_id": user_id})
-    total_items = len(items)
-    people_helped = 0
-    kg_diverted = 0.0
-    for it in items:
-        qty = it.get("quantity") or 0
-        unit = (it.get("unit") or "").lower()
-        if unit in ["kg", "kilo", "kilogram", "kilograms"]:
-            kg_diverted += float(qty)
-        elif unit in ["g", "gram", "grams"]:
-            kg_diverted += float(qty) / 1000.0
-        elif unit in ["lb", "lbs", "pound", "pounds"]:
-            kg_diverted += float(qty) * 0.453592
-        else:
-            # heuristic: 0.2kg per piece/pack
-            kg_diverted += float(qty) * 0.2
-        if it.get("available", True) is False:
-            people_helped += 1
+async def user_stats(user_id: str):
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$project": {
+            "available": 1,
+            "kg": {"$let": {
+                "vars": {
+                    "qty": {"$ifNull": ["$quantity", 0]},
+                    "unit": {"$toLower": {"$ifNull": ["$unit", ""]}},
+                },
+                "in": {"$multiply": ["$$qty", {"$switch": {
+                    "branches": _UNIT_TO_KG_BRANCHES,
+                    "default": DEFAULT_KG_PER_UNIT,
+                }}]},
+            }},
+        }},
+        {"$group": {
+            "_id": None,
+            "items_shared": {"$sum": 1},
+            "people_helped": {"$sum": {"$cond": [{"$eq": ["$available", False]}, 1, 0]}},
+            "kilograms_diverted": {"$sum": "$kg"},
+        }},
+    ]
+    rows = await aggregate_documents("item", pipeline)
+    stats = rows[0] if rows else {}
     return {
-        "items_shared": total_items,
-        "people_helped": people_helped,
-        "kilograms_diverted": round(kg_diverted, 2)
+        "items_shared": stats.get("items_shared", 0),
+        "people_helped": stats.get("people_helped", 0),
+        "kilograms_diverted": round(stats.get("kilograms_diverted", 0.0), 2)
     }
 
 